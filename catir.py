@@ -27,18 +27,70 @@
 """Smart Image Renamer main module"""
 
 import argparse
+import ctypes
+import errno
+import hashlib
+import io
 import itertools
 import os
-import re
-from pathlib import Path
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePath
 
 from PIL import Image
-from PIL.ExifTags import TAGS
 
-# Hideous monkeypatch. ymmv
-from PIL import JpegImagePlugin
+DEFAULT_TIMESTAMP_FORMAT = '{YYYY}-{MM}-{DD}_{hh}-{mm}-{ss}'
 
-JpegImagePlugin._getmp = lambda x: None
+# renameat2() from libc, used to rename without clobbering existing files
+_AT_FDCWD = -100
+_RENAME_NOREPLACE = 1
+
+
+def _load_renameat2():
+    """Return libc's renameat2(), or None if it isn't available"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                          ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    return renameat2
+
+
+_renameat2 = _load_renameat2()
+
+# Numeric IDs of the only EXIF tags we use. Reading these directly avoids
+# decoding every entry (thumbnails, MakerNote blobs) in the image
+_IFD0_TAGS = {'Artist': 0x013B, 'Make': 0x010F, 'Model': 0x0110}
+_EXIF_IFD = 0x8769
+_EXIF_IFD_TAGS = {'DateTimeOriginal': 0x9003, 'DateTimeDigitized': 0x9004}
+
+# Only files with these extensions (compared lowercased) are opened at all
+_IMG_EXTS = {'.jpg', '.jpeg', '.png', '.tif', '.tiff'}
+
+# The APP1 (EXIF) segment of a JPEG is at most 64 KB and sits at the start
+# of the file, so this much is enough to find the tags we need
+_JPEG_HEADER_SIZE = 65536
+
+# EXIF reads and renames are I/O bound, so use more threads than cores
+_MAX_WORKERS = min(16, (os.cpu_count() or 1) * 2)
+
+# On-disk caches of EXIF subsets, one file per image folder, keyed by file
+# name, so that re-runs don't have to open every image again. Each entry is
+# only trusted while the file's stat signature (see cache_signature()) is
+# unchanged. Bump _CACHE_VERSION whenever the cached data changes shape.
+_CACHE_VERSION = 3
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'catir')
+# folder -> (entries loaded from disk, entries used this run)
+_caches = {}
+_cache_lock = threading.Lock()
 
 
 class NotAnImageFile(Exception):
@@ -90,7 +142,7 @@ Forked from: https://github.com/ronakg/smart-image-renamer
                         help='Test mode. Don\'t apply changes.')
     parser.add_argument('--deployment-name', dest='deployment_name', default=None,
                         help='Deployment name (default: derived from directory structure)')
-    parser.add_argument('--timestamp-format', dest='timestamp_format', default='{YYYY}-{MM}-{DD}_{hh}-{mm}-{ss}',
+    parser.add_argument('--timestamp-format', dest='timestamp_format', default=DEFAULT_TIMESTAMP_FORMAT,
                         help='Custom input format for filename (default: "{YYYY}-{MM}-{DD}_{hh}-{mm}-{ss}")')
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-v", "--verbose", action="store_true")
@@ -101,8 +153,243 @@ Forked from: https://github.com/ronakg/smart-image-renamer
     return parser.parse_args()
 
 
-def get_exif_data(img_file):
-    """Read EXIF data from the image.
+def get_cache_file(folder):
+    """Return the path of the EXIF cache file for an image folder"""
+    digest = hashlib.sha1(os.fsencode(folder)).hexdigest()
+    return os.path.join(_CACHE_DIR, digest + '.cache')
+
+
+def cache_signature(st):
+    """Return the part of a file's stat result that EXIF cache entries
+    depend on.
+
+    mtime and size alone miss metadata edits that keep both, such as
+    exiftool -P rewriting a date of the same width. Tools that rewrite the
+    file get a new inode, and ctime can't be set back with utime().
+    """
+    return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_ctime_ns)
+
+
+def load_exif_cache(folder):
+    """Load the EXIF cache of an image folder from disk, once.
+
+    folder: Absolute path to the image folder
+
+    Returns: A (cached, seen) tuple of dictionaries mapping file names to
+             (signature, EXIF data) pairs. cached holds the entries read
+             from disk, seen the entries used during this run
+    """
+    with _cache_lock:
+        if folder not in _caches:
+            try:
+                with open(get_cache_file(folder), 'rb') as fh:
+                    version, entries = pickle.load(fh)
+                if version != _CACHE_VERSION or not isinstance(entries, dict):
+                    entries = {}
+            except Exception:
+                # The cache is only an optimisation, a missing or corrupt
+                # file just means starting from scratch
+                entries = {}
+            _caches[folder] = (entries, {})
+        return _caches[folder]
+
+
+def save_exif_cache():
+    """Atomically write back the EXIF caches that have changed.
+
+    Only the entries used during this run are written, so files that were
+    deleted or moved away drop out of their folder's cache.
+    """
+    for folder, (cached, seen) in _caches.items():
+        if seen == cached:
+            continue
+
+        cache_file = get_cache_file(folder)
+        tmp_file = None
+        try:
+            if not seen:
+                os.remove(cache_file)
+                continue
+            os.makedirs(_CACHE_DIR, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=_CACHE_DIR,
+                                             delete=False) as fh:
+                tmp_file = fh.name
+                pickle.dump((_CACHE_VERSION, seen), fh,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # Never fail a run because of the cache
+            if tmp_file and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+def rename_cached_exif(old_file, new_file):
+    """Move the cache entry of a renamed file to its new path.
+
+    old_file: Absolute path the file was read from
+    new_file: Absolute path the file has been renamed to
+    """
+    folder, old_name = os.path.split(old_file)
+    seen = load_exif_cache(folder)[1]
+    entry = seen.pop(old_name, None)
+    if entry is None:
+        return
+
+    try:
+        st = os.stat(new_file)
+    except OSError:
+        return
+
+    # Renaming updates ctime, but must not change anything else
+    signature = cache_signature(st)
+    if entry[0][:3] == signature[:3]:
+        seen[os.path.basename(new_file)] = (signature, entry[1])
+
+
+def iter_folders(top, recursive, include_hidden):
+    """Walk a directory tree top-down using os.scandir().
+
+    top: Absolute path to the directory to start from
+    recursive: Descend into subdirectories
+    include_hidden: Descend into hidden subdirectories as well
+
+    Yields: (dirpath, file_entries) tuples, where file_entries holds the
+            os.DirEntry objects of all non-directory entries in dirpath
+    """
+    try:
+        with os.scandir(top) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    yield top, [entry for entry in entries if not entry.is_dir()]
+
+    if not recursive:
+        return
+
+    subdirs = sorted((entry for entry in entries
+                      if entry.is_dir(follow_symlinks=False)),
+                     key=lambda entry: entry.name)
+    for entry in subdirs:
+        if include_hidden or not entry.name.startswith('.'):
+            yield from iter_folders(entry.path, recursive, include_hidden)
+
+
+def jpeg_exif_data(img_file):
+    """Read the EXIF tags we use straight from a JPEG's APP1 segment.
+
+    This skips Pillow entirely, which matters when renaming thousands of
+    camera trap images. Anything unexpected makes it give up, so that the
+    caller can fall back to pillow_exif_data().
+
+    img_file: Absolute path to the image file
+
+    Returns: A dictionary containing EXIF data of the file, or None if the
+             file is not a JPEG or its EXIF could not be parsed here
+    """
+    try:
+        with open(img_file, 'rb') as fh:
+            data = fh.read(_JPEG_HEADER_SIZE)
+    except OSError:
+        return None
+
+    if not data.startswith(b'\xff\xd8'):
+        return None
+
+    try:
+        # Find the APP1 Exif segment among the markers before the image data
+        pos = 2
+        while True:
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+                continue
+            if marker in (0xDA, 0xD9):
+                # Start of scan or end of image, there is no EXIF
+                return None
+            seg_len, = struct.unpack_from('>H', data, pos + 2)
+            if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\x00\x00':
+                if pos + 2 + seg_len > len(data):
+                    return None
+                tiff = data[pos + 10:pos + 2 + seg_len]
+                break
+            pos += 2 + seg_len
+
+        # TIFF header: byte order, magic number 42, offset of IFD0
+        if tiff[:2] == b'II':
+            endian = '<'
+        elif tiff[:2] == b'MM':
+            endian = '>'
+        else:
+            return None
+        magic, ifd0_offset = struct.unpack_from(endian + 'HI', tiff, 2)
+        if magic != 42:
+            return None
+
+        ifd0 = _read_ifd(tiff, endian, ifd0_offset)
+        if not ifd0:
+            return None
+
+        exif_data = {}
+        for name, tag in _IFD0_TAGS.items():
+            if tag in ifd0:
+                exif_data[name] = _ifd_string(tiff, endian, ifd0[tag])
+
+        exif_ifd = {}
+        if _EXIF_IFD in ifd0:
+            tag_type, count, value = ifd0[_EXIF_IFD]
+            if tag_type != 4:
+                return None
+            exif_ifd_offset, = struct.unpack_from(endian + 'I', value)
+            exif_ifd = _read_ifd(tiff, endian, exif_ifd_offset)
+
+        for name, tag in _EXIF_IFD_TAGS.items():
+            # Some cameras write these to IFD0 instead of the Exif IFD
+            entry = exif_ifd.get(tag) or ifd0.get(tag)
+            if entry:
+                exif_data[name] = _ifd_string(tiff, endian, entry)
+    except (IndexError, ValueError, struct.error):
+        return None
+
+    exif_data['format'] = 'JPEG'
+    return exif_data
+
+
+def _read_ifd(tiff, endian, offset):
+    """Return {tag: (type, count, raw 4 byte value)} for a TIFF IFD"""
+    count, = struct.unpack_from(endian + 'H', tiff, offset)
+    entries = {}
+    for i in range(count):
+        tag, tag_type, value_count = struct.unpack_from(
+            endian + 'HHI', tiff, offset + 2 + i * 12)
+        value_pos = offset + 2 + i * 12 + 8
+        entries[tag] = (tag_type, value_count, tiff[value_pos:value_pos + 4])
+    return entries
+
+
+def _ifd_string(tiff, endian, entry):
+    """Decode an ASCII IFD entry the way Pillow does
+
+    Raises: ValueError if the entry is not ASCII
+    """
+    tag_type, count, value = entry
+    if tag_type != 2:
+        raise ValueError
+    if count > 4:
+        offset, = struct.unpack_from(endian + 'I', value)
+        value = tiff[offset:offset + count]
+        if len(value) != count:
+            raise ValueError
+    else:
+        value = value[:count]
+    return value.rstrip(b'\x00').decode('latin-1', 'replace')
+
+
+def pillow_exif_data(img_file):
+    """Read EXIF data from any image format Pillow understands.
 
     img_file: Absolute path to the image file
 
@@ -116,21 +403,174 @@ def get_exif_data(img_file):
     except (OSError, IOError):
         raise NotAnImageFile
 
-    try:
-        # Use TAGS module to make EXIF data human readable
-        exif_data = {
-            TAGS[k]: v
-            for k, v in img._getexif().items()
-            if k in TAGS
-        }
-    except AttributeError:
-        raise InvalidExifData
+    # Only headers are read here; pixel data is never decoded
+    with img:
+        # MPO files are JPEGs with extra frames appended, name them as such
+        fmt = 'JPEG' if img.format == 'MPO' else img.format
+        try:
+            exif = img.getexif()
+            if not exif:
+                raise InvalidExifData
+
+            # Only pull the tags we need, by numeric ID
+            exif_data = {name: exif[tag] for name, tag in _IFD0_TAGS.items()
+                         if tag in exif}
+            exif_ifd = exif.get_ifd(_EXIF_IFD)
+            for name, tag in _EXIF_IFD_TAGS.items():
+                # Some cameras write these to IFD0 instead of the Exif IFD
+                if tag in exif_ifd:
+                    exif_data[name] = exif_ifd[tag]
+                elif tag in exif:
+                    exif_data[name] = exif[tag]
+        except Exception:
+            # Corrupt EXIF can fail in many ways inside Pillow
+            raise InvalidExifData
 
     # Add image format to EXIF
-    exif_data['format'] = img.format
+    exif_data['format'] = fmt
     return exif_data
 
 
+def get_exif_data(img_file):
+    """Read EXIF data from the image.
+
+    img_file: Absolute path to the image file
+
+    Returns: A dictionary containing EXIF data of the file
+
+    Raises: NotAnImageFile if file is not an image
+            InvalidExifData if EXIF can't be processed
+    """
+    try:
+        st = os.stat(img_file)
+    except OSError:
+        raise NotAnImageFile
+
+    folder, name = os.path.split(img_file)
+    cached, seen = load_exif_cache(folder)
+    signature = cache_signature(st)
+    entry = cached.get(name)
+    if entry is not None and entry[0] == signature:
+        exif_data = entry[1]
+    else:
+        exif_data = jpeg_exif_data(img_file)
+        if exif_data is None:
+            exif_data = pillow_exif_data(img_file)
+
+    seen[name] = (signature, exif_data)
+    return dict(exif_data)
+
+
+def read_exif_data(img_file):
+    """Thread pool friendly wrapper around get_exif_data().
+
+    img_file: Absolute path to the image file
+
+    Returns: The EXIF dictionary, or the NotAnImageFile/InvalidExifData
+             exception raised while reading it
+    """
+    try:
+        return get_exif_data(img_file)
+    except (NotAnImageFile, InvalidExifData) as e:
+        return e
+
+
+def get_deployment_name(input_path):
+    """Derive the deployment name from the directory structure.
+
+    Input folders are laid out as <deployment>/<x>/<y>/<folder>, so the
+    deployment is the fourth last component of the path.
+
+    input_path: Absolute path to the input directory
+
+    Returns: The deployment name, or None if the path is too short
+    """
+    parts = PurePath(input_path).parts
+    if len(parts) < 5:
+        return None
+    return parts[-4]
+
+
+def rename_no_replace(old_file, new_file):
+    """Rename a file without ever overwriting an existing one.
+
+    On Linux renameat2(RENAME_NOREPLACE) lets the kernel check for the
+    destination atomically. Elsewhere, and on filesystems that don't support
+    the flag, this falls back to os.rename().
+
+    Raises: FileExistsError if new_file exists (Linux only)
+            OSError if the rename fails
+    """
+    if _renameat2 is not None:
+        if _renameat2(_AT_FDCWD, os.fsencode(old_file),
+                      _AT_FDCWD, os.fsencode(new_file), _RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(err, os.strerror(err), old_file, None, new_file)
+    os.rename(old_file, new_file)
+
+
+def safe_rename(old_file, new_file):
+    """Rename a file, reporting failure instead of raising.
+
+    old_file: Absolute path to the file
+    new_file: Absolute path to rename the file to
+
+    Returns: None on success, or an (old_file, error) skipped files entry
+    """
+    try:
+        rename_no_replace(old_file, new_file)
+    except FileExistsError:
+        return (old_file, 'Destination file already exists')
+    except OSError:
+        return (old_file, 'Failed to rename file')
+    rename_cached_exif(old_file, new_file)
+    return None
+
+
+def apply_renames(rename_ops):
+    """Apply a folder's renames, in parallel where they don't depend on
+    each other.
+
+    A rename may target the old name of another file in the batch, which is
+    only free once that file has been renamed away. Such renames wait for a
+    later round, and are given up on if that file could not be renamed.
+
+    rename_ops: List of (old_file, new_file) absolute path pairs
+
+    Returns: A dictionary mapping old_file to the error message of each
+             rename that failed
+    """
+    failed = {}
+    pending = rename_ops
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        while pending:
+            sources = {old_file for old_file, new_file in pending}
+            ready = []
+            waiting = []
+            for old_file, new_file in pending:
+                if new_file in failed:
+                    failed[old_file] = 'Destination file already exists'
+                elif new_file in sources:
+                    waiting.append((old_file, new_file))
+                else:
+                    ready.append((old_file, new_file))
+
+            if not ready:
+                # Renames only ever wait on files queued before them, so
+                # this can't happen, but never loop forever
+                failed.update((old_file, 'Destination file already exists')
+                              for old_file, new_file in waiting)
+                break
+
+            for skipped in executor.map(lambda op: safe_rename(*op), ready):
+                if skipped:
+                    failed[skipped[0]] = skipped[1]
+            pending = waiting
+    return failed
+
+
 def main():
     """Read CLI arguments and execute the script"""
 
@@ -145,35 +585,67 @@ def main():
     test_mode = args.test
     recursive = args.recursive
     include_hidden = args.hidden
-    deployment_name = args.deployment_name
 
+    # Build the full filename template once, not per image. The default
+    # format is common enough to skip str.format altogether.
+    if timestamp_format == DEFAULT_TIMESTAMP_FORMAT:
+        def make_file_name(data):
+            return (f"{data['YYYY']}-{data['MM']}-{data['DD']}_"
+                    f"{data['hh']}-{data['mm']}-{data['ss']}.{data['ext']}")
+    else:
+        make_file_name = (timestamp_format + '.{ext}').format_map
+
+    # Work out every deployment name before renaming anything, so a bad
+    # input path can't stop the run halfway through
+    deployments = []
     for input_path in input_paths:
-        for root, dirs, files in os.walk(input_path):
-            # Skip hidden directories unless specified by user 
-            if not include_hidden and os.path.basename(root).startswith('.'):
-                continue
-
-            # Initialize sequence counter
-            # Use no of files to determine padding for sequence numbers
-            seq = itertools.count(start=sequence_start)
-            seq_width = len(str(len(files)))
-
+        # Skip hidden directories unless specified by user. Hidden
+        # subdirectories are already pruned by iter_folders()
+        if not include_hidden and input_path.rpartition(os.sep)[2].startswith('.'):
+            continue
+
+        deployment_name = args.deployment_name or get_deployment_name(input_path)
+        if not deployment_name:
+            sys.exit('Could not derive a deployment name from {}, '
+                     'use --deployment-name'.format(input_path))
+        deployments.append((input_path, deployment_name))
+
+    for input_path, deployment_name in deployments:
+        for root, files in iter_folders(input_path, recursive, include_hidden):
             print('Processing folder: {}'.format(root))
 
             unduplicator = 1
+            rename_ops = []
 
-            for f in sorted(files):
-                # Skip hidden files unless specified by user 
-                if not include_hidden and f.startswith('.'):
-                    continue
+            # Names already taken in this folder, so duplicates can be
+            # resolved without a stat() call per candidate name
+            existing = {entry.name for entry in files}
 
-                old_file_name = os.path.join(root, f)
-                try:
-                    # Get EXIF data from the image
-                    exif_data = get_exif_data(old_file_name)
-                except NotAnImageFile:
+            # Skip hidden files unless specified by user, and anything that
+            # isn't named like an image
+            visible_files = sorted((entry for entry in files
+                                    if (include_hidden or not entry.name.startswith('.'))
+                                    and os.path.splitext(entry.name)[1].lower() in _IMG_EXTS),
+                                   key=lambda entry: entry.name)
+
+            # Initialize sequence counter
+            # Use the highest sequence number to determine padding
+            seq = itertools.count(start=sequence_start)
+            seq_width = len(str(len(visible_files) + sequence_start - 1))
+
+            # Get EXIF data from the images in parallel. Renaming below stays
+            # serial so duplicates and sequence numbers resolve in order.
+            with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+                exif_results = list(executor.map(
+                    read_exif_data,
+                    [entry.path for entry in visible_files]))
+
+            for entry, exif_data in zip(visible_files, exif_results):
+                f = entry.name
+                old_file_name = entry.path
+                if isinstance(exif_data, NotAnImageFile):
                     continue
-                except InvalidExifData:
+                if isinstance(exif_data, InvalidExifData):
                     skipped_files.append((old_file_name, 'No EXIF data found'))
                     continue
 
@@ -187,12 +659,17 @@ def main():
                     continue
 
                 # Extract year, month, day, hours, minutes, seconds from timestamp
-                img_timestamp = \
-                    re.search(r'(?P<YYYY>\d\d\d?\d?):(?P<MM>\d\d?):(?P<DD>\d\d?) '
-                              '(?P<hh>\d\d?):(?P<mm>\d\d?):(?P<ss>\d\d?)',
-                              img_timestamp.strip())
-
-                if not img_timestamp:
+                # EXIF timestamps are of the form "YYYY:MM:DD hh:mm:ss"
+                try:
+                    date, time = img_timestamp.strip().split(' ', 1)
+                    YYYY, MM, DD = date.split(':')
+                    hh, mm, ss = time.strip().split(':')
+                    timestamp = {'YYYY': YYYY, 'MM': MM, 'DD': DD,
+                                 'hh': hh, 'mm': mm, 'ss': ss}
+                    # Blank timestamps ("    :  :     :  :  ") are common
+                    if not all(v.isascii() and v.isdecimal() for v in timestamp.values()):
+                        raise ValueError
+                except ValueError:
                     skipped_files.append((old_file_name,
                                           'Timestamp not in correct format'))
                     continue
@@ -205,58 +682,68 @@ def main():
                                   'Seq': '{0:0{1}d}'.format(next(seq), seq_width),
                                   'ext': exif_data.get('format', '')
                                   }
-                new_image_data.update(img_timestamp.groupdict())
+                new_image_data.update(timestamp)
 
                 # Generate new file name according to user provided format
-                new_file_name = (timestamp_format + '.{ext}').format(**new_image_data)
-                new_file_name_with_path = os.path.join(root, new_file_name)
-                import os.path as path
-
-                if not deployment_name:
-                    deployment_name = new_file_name_with_path.split("/")[-5]
-                new_file_name_complete = os.path.join(root, deployment_name + "_" + new_file_name)
+                new_file_name = make_file_name(new_image_data)
+                final_name = deployment_name + "_" + new_file_name
 
                 # Don't overwrite an already existing file. Instead, increment {ss} until we have a unique filename.
-                while (os.path.isfile(new_file_name_complete)):
-                    print("Duplicate file found: " + new_file_name_complete)
+                if final_name in existing:
+                    # Only the seconds change, so keep everything else as is
+                    base_no_secs = new_file_name[:17]
+                    seconds = int(new_file_name.split('.', 1)[0][-2:])
+                    ext = new_image_data['ext']
 
-                    current_args = new_file_name.split('.', 1)
-                    seconds = int(current_args[0][-2:])
-                    rest_of_args = current_args[0][:17]
-                    seconds += 1
+                    while final_name in existing:
+                        print("Duplicate file found: " + os.path.join(root, final_name))
 
-                    new_file_name = (rest_of_args + str(seconds).zfill(2) + '.{ext}').format(**new_image_data)
-                    new_file_name_complete = os.path.join(root, deployment_name + "_" + new_file_name)
+                        seconds += 1
+                        new_file_name = f"{base_no_secs}{seconds:02d}.{ext}"
+                        final_name = f"{deployment_name}_{new_file_name}"
 
-                    print("Renaming file to: " + new_file_name_complete)
+                        print("Renaming file to: " + os.path.join(root, final_name))
 
-                # Don't rename files if we are running in test mode
-                if not test_mode:
-                    try:
-                        os.rename(old_file_name, new_file_name_complete)
-                    except OSError:
-                        skipped_files.append((old_file_name,
-                                              'Failed to rename file'))
-                        continue
+                new_file_name_complete = os.path.join(root, final_name)
 
                 if verbose:
-                    print('{0} --> {1}'.format(old_file_name,
-                                               new_file_name_complete))
+                    message = '{0} --> {1}'.format(old_file_name,
+                                                   new_file_name_complete)
+                else:
+                    message = '{0} --> {1}'.format(f, new_file_name)
+                rename_ops.append((old_file_name, new_file_name_complete,
+                                   message))
+
+                existing.discard(f)
+                existing.add(final_name)
+
+            # Apply this folder's renames, unless we are running in test mode
+            if test_mode:
+                failed = {}
+            else:
+                failed = apply_renames([(old_file, new_file) for
+                                        old_file, new_file, message in rename_ops])
+
+            for old_file, new_file, message in rename_ops:
+                if old_file in failed:
+                    skipped_files.append((old_file, failed[old_file]))
                 elif not quiet:
-                    print('{0} --> {1}'.format(f, new_file_name))
+                    print(message)
 
             # Folder processed
             print('')
 
-            # Break if recursive flag is not present
-            if not recursive:
-                break
+    # Test mode doesn't change anything on disk, the cache included
+    if not test_mode:
+        save_exif_cache()
 
     # Print skipped files
     if skipped_files and not quiet:
-        print('\nSkipped Files:\n\t' + '\n\t'.join([file + ' (' + error + ')'
-                                                    for file, error in
-                                                    skipped_files]))
+        buf = io.StringIO()
+        buf.write('\nSkipped Files:\n')
+        for file, error in skipped_files:
+            buf.write(f'\t{file} ({error})\n')
+        sys.stdout.write(buf.getvalue())
 
 
 if __name__ == '__main__':
@@ -5,7 +5,7 @@ setup(
     version='0.6',
     py_modules=['catir'],
     install_requires=[
-        'Pillow',
+        'Pillow>=8.2',
     ],
     entry_points={
         'console_scripts': [